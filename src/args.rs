@@ -54,7 +54,11 @@ pub struct Args {
     #[arg(long)]
     pub no_patterns: bool,
 
-    /// Custom temporary file path for database copy
+    /// Copy the history database to a temporary file instead of reading it in place
+    #[arg(long)]
+    pub copy: bool,
+
+    /// Custom temporary file path for database copy (implies --copy)
     #[arg(long)]
     pub temp_path: Option<PathBuf>,
 
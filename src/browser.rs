@@ -1,11 +1,18 @@
 use anyhow::Result;
 use chrono::{DateTime, Utc};
 use rusqlite::Connection;
+use std::collections::HashMap;
 use std::fs;
 use std::time::Instant;
 use tracing::{info, warn};
 
-use crate::{args::Browser, patterns, sqlite, stats::AnalysisResult, Args};
+use crate::{
+    args::Browser,
+    patterns::{self, DomainPatterns},
+    sqlite,
+    stats::AnalysisResult,
+    Args,
+};
 
 /// Trait for browser-specific operations
 pub trait BrowserHandler {
@@ -14,7 +21,7 @@ pub trait BrowserHandler {
     fn extract_domains(
         &self,
         conn: &Connection,
-        patterns: &[regex::Regex],
+        patterns: &DomainPatterns,
         workers: Option<usize>,
     ) -> Result<crate::stats::DomainStats>;
 }
@@ -38,7 +45,7 @@ impl BrowserHandler for Browser {
     fn extract_domains(
         &self,
         conn: &Connection,
-        patterns: &[regex::Regex],
+        patterns: &DomainPatterns,
         workers: Option<usize>,
     ) -> Result<crate::stats::DomainStats> {
         match self {
@@ -68,24 +75,48 @@ fn analyze_single_browser(browser: &Browser, args: &Args) -> Result<AnalysisResu
     );
 
     let history_path = browser.get_history_path()?;
-    let temp_history_path =
-        sqlite::copy_history_database(&history_path, args.temp_path.as_deref())?;
+
+    // Read the live database in place unless a copy was requested
+    let temp_history_path = if args.copy || args.temp_path.is_some() {
+        Some(sqlite::copy_history_database(
+            &history_path,
+            args.temp_path.as_deref(),
+        )?)
+    } else {
+        None
+    };
 
     let patterns = if args.no_patterns {
-        Vec::new()
+        DomainPatterns::default()
     } else {
         patterns::load_domain_patterns(args.patterns.as_deref())?
     };
 
-    let conn = Connection::open(&temp_history_path)?;
+    let conn = match &temp_history_path {
+        Some(temp_history_path) => Connection::open(temp_history_path)?,
+        None => sqlite::open_history_database(&history_path)?,
+    };
     info!(
         action = "connect",
         component = "database",
         "Connected to database"
     );
-
-    let date_range = browser.get_date_range(&conn)?;
-    let stats = browser.extract_domains(&conn, &patterns, args.workers)?;
+    // Only the copy is ours alone, so the live database is never memory-mapped
+    sqlite::configure_connection(&conn, temp_history_path.is_some())?;
+
+    // A browser writing to the file can break an in-place read partway through, which a copy
+    // avoids; other query errors would fail the same way on a copy
+    let copy_hint = |e: anyhow::Error| {
+        if temp_history_path.is_none() && sqlite::is_concurrent_write_error(&e) {
+            e.context("History database changed while reading it in place; retry with --copy")
+        } else {
+            e
+        }
+    };
+    let date_range = browser.get_date_range(&conn).map_err(copy_hint)?;
+    let stats = browser
+        .extract_domains(&conn, &patterns, args.workers)
+        .map_err(copy_hint)?;
 
     info!(
         action = "disconnect",
@@ -95,8 +126,10 @@ fn analyze_single_browser(browser: &Browser, args: &Args) -> Result<AnalysisResu
     drop(conn);
 
     // Clean up temporary file
-    if let Err(e) = fs::remove_file(&temp_history_path) {
-        warn!(action = "cleanup", component = "temp_file", error = %e, "Failed to remove temporary file");
+    if let Some(temp_history_path) = &temp_history_path {
+        if let Err(e) = fs::remove_file(temp_history_path) {
+            warn!(action = "cleanup", component = "temp_file", error = %e, "Failed to remove temporary file");
+        }
     }
 
     let total_time = total_start_time.elapsed();
@@ -119,11 +152,7 @@ fn analyze_all_browsers(args: &Args) -> Result<AnalysisResult> {
         Browser::Vivaldi,
         Browser::Zen,
     ];
-    let mut all_stats = crate::stats::DomainStats {
-        unique_domains: Vec::new(),
-        domain_counts: std::collections::HashMap::new(),
-        domains_removed: 0,
-    };
+    let mut all_stats = crate::stats::DomainStats::default();
 
     let mut earliest_date_str = None;
     let mut latest_date_str = None;
@@ -171,9 +200,6 @@ fn analyze_all_browsers(args: &Args) -> Result<AnalysisResult> {
         }
     }
 
-    // Update unique_domains from the final domain_counts
-    all_stats.unique_domains = all_stats.domain_counts.keys().cloned().collect();
-
     // Calculate the total days between earliest and latest
     let total_days = if let (Some(earliest), Some(latest)) = (earliest_timestamp, latest_timestamp)
     {
@@ -218,23 +244,18 @@ pub fn print_analysis_results(result: &AnalysisResult, args: &Args) {
 
     println!(
         "Total unique domains found: {}",
-        crate::utils::format_number(result.stats.unique_domains.len() as u32)
+        crate::utils::format_number(result.stats.domain_counts.len() as u32)
     );
     println!(
         "Domains removed (no valid TLD): {}",
         crate::utils::format_number(result.stats.domains_removed)
     );
 
-    // Sort domains by count
-    let mut sorted_domains: Vec<(&String, &u32)> = result.stats.domain_counts.iter().collect();
-    sorted_domains.sort_by(|a, b| b.1.cmp(a.1));
-
     if let Some(top_count) = args.top {
-        println!(
-            "\nTop {} most visited domains:",
-            std::cmp::min(top_count, sorted_domains.len())
-        );
-        for (domain, count) in sorted_domains.iter().take(top_count) {
+        let top_domains = select_domains(&result.stats.domain_counts, top_count, true);
+
+        println!("\nTop {} most visited domains:", top_domains.len());
+        for (domain, count) in top_domains {
             let display_domain = if args.redact {
                 crate::utils::redact_domain(domain)
             } else {
@@ -243,20 +264,16 @@ pub fn print_analysis_results(result: &AnalysisResult, args: &Args) {
             println!(
                 "- {}: {} visits",
                 display_domain,
-                crate::utils::format_number(**count)
+                crate::utils::format_number(*count)
             );
         }
     }
 
     if let Some(bottom_count) = args.bottom {
-        let mut bottom_sorted = sorted_domains.clone();
-        bottom_sorted.sort_by(|a, b| a.1.cmp(b.1));
+        let bottom_domains = select_domains(&result.stats.domain_counts, bottom_count, false);
 
-        println!(
-            "\nBottom {} least visited domains:",
-            std::cmp::min(bottom_count, bottom_sorted.len())
-        );
-        for (domain, count) in bottom_sorted.iter().take(bottom_count) {
+        println!("\nBottom {} least visited domains:", bottom_domains.len());
+        for (domain, count) in bottom_domains {
             let display_domain = if args.redact {
                 crate::utils::redact_domain(domain)
             } else {
@@ -265,8 +282,34 @@ pub fn print_analysis_results(result: &AnalysisResult, args: &Args) {
             println!(
                 "- {}: {} visits",
                 display_domain,
-                crate::utils::format_number(**count)
+                crate::utils::format_number(*count)
             );
         }
     }
 }
+
+/// Returns the `count` most (or least) visited domains, ordered by visit count.
+///
+/// Partially selects the wanted entries first so only those are sorted, rather than
+/// sorting every domain to print a handful.
+fn select_domains(
+    domain_counts: &HashMap<String, u32>,
+    count: usize,
+    most_visited: bool,
+) -> Vec<(&String, &u32)> {
+    let compare = |a: &(&String, &u32), b: &(&String, &u32)| {
+        if most_visited {
+            b.1.cmp(a.1)
+        } else {
+            a.1.cmp(b.1)
+        }
+    };
+
+    let mut domains: Vec<(&String, &u32)> = domain_counts.iter().collect();
+    if count < domains.len() {
+        domains.select_nth_unstable_by(count, compare);
+        domains.truncate(count);
+    }
+    domains.sort_by(compare);
+    domains
+}
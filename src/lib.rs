@@ -8,5 +8,5 @@ pub mod utils;
 
 pub use args::{Args, Browser};
 pub use browser::{analyze_browser_history, BrowserHandler};
-pub use patterns::init_default_patterns;
+pub use patterns::{init_default_patterns, DomainPatterns};
 pub use stats::{AnalysisResult, DomainStats};
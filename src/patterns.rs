@@ -1,5 +1,6 @@
 use anyhow::{Context, Result};
-use regex::Regex;
+use regex::{Regex, RegexSet, RegexSetBuilder};
+use std::collections::HashMap;
 use std::fs;
 use std::path::Path;
 use std::time::Instant;
@@ -8,7 +9,138 @@ use tracing::{info, warn};
 // Include default patterns at compile time
 const DEFAULT_PATTERNS_BYTES: &[u8] = include_bytes!("../default_domain_patterns.txt");
 
-pub fn load_domain_patterns(pattern_file_path: Option<&Path>) -> Result<Vec<Regex>> {
+/// Lazy DFA cache size for the combined pattern set. The regex crate abandons its DFA for
+/// the slower PikeVM once the cache thrashes, which large user pattern files can trigger at
+/// the default 2 MiB.
+const PATTERN_SET_DFA_SIZE_LIMIT: usize = 8 * (1 << 20);
+
+/// Compiled domain normalization patterns.
+///
+/// Patterns of the form `^.+\.(suffix)$` with a literal suffix are answered by looking up
+/// each label boundary of the domain in a hash map. The remaining patterns are combined into
+/// a single `RegexSet`, so a domain is scanned once to find every matching pattern; only the
+/// winning pattern is then run for its capture group.
+#[derive(Debug, Clone)]
+pub struct DomainPatterns {
+    /// Literal suffixes mapped to the index of the first pattern that declared them
+    suffixes: HashMap<String, usize>,
+    set: RegexSet,
+    /// Non-suffix patterns paired with their index in the pattern list
+    regexes: Vec<(usize, Regex)>,
+    len: usize,
+}
+
+impl DomainPatterns {
+    pub fn new(patterns: Vec<Regex>) -> Result<Self> {
+        let len = patterns.len();
+        let mut suffixes = HashMap::new();
+        let mut regexes = Vec::new();
+
+        for (index, regex) in patterns.into_iter().enumerate() {
+            match literal_suffix(regex.as_str()) {
+                Some(suffix) => {
+                    suffixes.entry(suffix).or_insert(index);
+                }
+                None => regexes.push((index, regex)),
+            }
+        }
+
+        let set = RegexSetBuilder::new(regexes.iter().map(|(_, regex)| regex.as_str()))
+            .dfa_size_limit(PATTERN_SET_DFA_SIZE_LIMIT)
+            .build()
+            .context("Failed to combine domain patterns")?;
+        Ok(Self {
+            suffixes,
+            set,
+            regexes,
+            len,
+        })
+    }
+
+    pub fn len(&self) -> usize {
+        self.len
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.len == 0
+    }
+
+    /// Returns capture group 1 of the first pattern, in file order, that matches `domain`.
+    pub fn captured<'a>(&self, domain: &'a str) -> Option<&'a str> {
+        let suffix_match = self.match_suffix(domain);
+        let limit = suffix_match.map_or(usize::MAX, |(index, _)| index);
+
+        // Only consult the regexes if one of them could take priority over the suffix match
+        let first_regex = self.regexes.first().map_or(usize::MAX, |(index, _)| *index);
+        if first_regex < limit {
+            let regex_match = self
+                .set
+                .matches(domain)
+                .into_iter()
+                .map(|i| &self.regexes[i])
+                .take_while(|(index, _)| *index < limit)
+                .find_map(|(_, regex)| regex.captures(domain)?.get(1));
+            if let Some(matched) = regex_match {
+                return Some(matched.as_str());
+            }
+        }
+
+        suffix_match.map(|(_, suffix)| suffix)
+    }
+
+    /// Finds the highest-priority literal suffix that follows a `.` in `domain`.
+    fn match_suffix<'a>(&self, domain: &'a str) -> Option<(usize, &'a str)> {
+        if self.suffixes.is_empty() {
+            return None;
+        }
+
+        // `^.+\.` requires at least one character before the separating dot
+        domain
+            .match_indices('.')
+            .filter(|&(i, _)| i > 0)
+            .filter_map(|(i, _)| {
+                let suffix = &domain[i + 1..];
+                self.suffixes.get(suffix).map(|&index| (index, suffix))
+            })
+            .min_by_key(|&(index, _)| index)
+    }
+}
+
+impl Default for DomainPatterns {
+    fn default() -> Self {
+        Self {
+            suffixes: HashMap::new(),
+            set: RegexSet::empty(),
+            regexes: Vec::new(),
+            len: 0,
+        }
+    }
+}
+
+/// Extracts the literal suffix from a pattern of the form `^.+\.(suffix)$`.
+///
+/// Returns `None` if the captured group contains anything other than alphanumerics, `-`,
+/// `_`, or escaped dots.
+fn literal_suffix(pattern: &str) -> Option<String> {
+    let inner = pattern.strip_prefix(r"^.+\.(")?.strip_suffix(")$")?;
+    let mut suffix = String::with_capacity(inner.len());
+    let mut chars = inner.chars();
+
+    while let Some(c) = chars.next() {
+        match c {
+            '\\' => match chars.next() {
+                Some('.') => suffix.push('.'),
+                _ => return None,
+            },
+            c if c.is_ascii_alphanumeric() || c == '-' || c == '_' => suffix.push(c),
+            _ => return None,
+        }
+    }
+
+    (!suffix.is_empty()).then_some(suffix)
+}
+
+pub fn load_domain_patterns(pattern_file_path: Option<&Path>) -> Result<DomainPatterns> {
     let start_time = Instant::now();
     info!(
         action = "start",
@@ -95,7 +227,7 @@ pub fn load_domain_patterns(pattern_file_path: Option<&Path>) -> Result<Vec<Rege
         duration_ms = pattern_time.as_millis(),
         "Successfully compiled patterns"
     );
-    Ok(patterns)
+    DomainPatterns::new(patterns)
 }
 
 pub fn init_default_patterns() -> Result<()> {
@@ -115,3 +247,73 @@ pub fn init_default_patterns() -> Result<()> {
 
     Ok(())
 }
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn domain_patterns(patterns: &[&str]) -> DomainPatterns {
+        let patterns = patterns.iter().map(|p| Regex::new(p).unwrap()).collect();
+        DomainPatterns::new(patterns).unwrap()
+    }
+
+    #[test]
+    fn earlier_regex_wins_over_later_suffix() {
+        let patterns = domain_patterns(&[r"^(.+\.example\.com)$", r"^.+\.(example\.com)$"]);
+        assert_eq!(patterns.captured("a.example.com"), Some("a.example.com"));
+    }
+
+    #[test]
+    fn earlier_suffix_wins_over_later_regex() {
+        let patterns = domain_patterns(&[r"^.+\.(example\.com)$", r"^(.+\.example\.com)$"]);
+        assert_eq!(patterns.captured("a.example.com"), Some("example.com"));
+    }
+
+    #[test]
+    fn suffixes_match_in_file_order_not_by_length() {
+        let patterns = domain_patterns(&[r"^.+\.(com)$", r"^.+\.(example\.com)$"]);
+        assert_eq!(patterns.captured("a.example.com"), Some("com"));
+    }
+
+    #[test]
+    fn match_without_group_falls_through() {
+        let patterns = domain_patterns(&[r"^(x)?a\.example\.com$", r"^.+\.(example\.com)$"]);
+        assert_eq!(patterns.captured("a.example.com"), Some("example.com"));
+
+        let patterns = domain_patterns(&[r"^a\.example\.com$", r"^(a)\.example\.com$"]);
+        assert_eq!(patterns.captured("a.example.com"), Some("a"));
+    }
+
+    #[test]
+    fn duplicate_suffix_keeps_first_index() {
+        let patterns = domain_patterns(&[
+            r"^.+\.(example\.com)$",
+            r"^(.+)\.example\.com$",
+            r"^.+\.(example\.com)$",
+        ]);
+        assert_eq!(patterns.captured("a.example.com"), Some("example.com"));
+    }
+
+    #[test]
+    fn suffix_requires_a_label_before_it() {
+        let patterns = domain_patterns(&[r"^.+\.(example\.com)$"]);
+        assert_eq!(patterns.captured("example.com"), None);
+        assert_eq!(patterns.captured("a.notexample.com"), None);
+        assert_eq!(DomainPatterns::default().captured("a.example.com"), None);
+    }
+
+    #[test]
+    fn literal_suffix_accepts_only_escaped_dots() {
+        assert_eq!(
+            literal_suffix(r"^.+\.(example\.co-uk)$").as_deref(),
+            Some("example.co-uk")
+        );
+        assert_eq!(literal_suffix(r"^.+\.(\d+\.com)$"), None);
+        assert_eq!(literal_suffix(r"^.+\.(\w+)$"), None);
+        assert_eq!(literal_suffix(r"^.+\.([a-z]+)$"), None);
+        assert_eq!(literal_suffix(r"^.+\.(a|b)$"), None);
+        assert_eq!(literal_suffix(r"^.+\.(example.com)$"), None);
+        assert_eq!(literal_suffix(r"^.+\.()$"), None);
+        assert_eq!(literal_suffix(r"^(.+)\.example\.com$"), None);
+    }
+}
@@ -1,14 +1,17 @@
 use anyhow::{Context, Result};
 use chrono::{DateTime, Utc};
 use rayon::prelude::*;
-use rusqlite::{Connection, Result as SqliteResult};
+use rusqlite::{Connection, ErrorCode, OpenFlags};
+use rustc_hash::FxHashMap;
 use std::env;
 use std::fs;
 use std::path::{Path, PathBuf};
+use std::sync::mpsc;
 use std::time::Instant;
 use tracing::{info, warn};
 
 use crate::args::Browser;
+use crate::patterns::DomainPatterns;
 
 pub fn get_browser_history_path(browser: &Browser) -> Result<PathBuf> {
     let system = env::consts::OS;
@@ -220,6 +223,8 @@ pub fn copy_history_database(history_path: &Path, temp_path: Option<&Path>) -> R
         anyhow::bail!("History file not found at {:?}", history_path);
     }
 
+    // fs::copy already copies in-kernel where it can (copy_file_range/sendfile on Linux,
+    // fcopyfile on macOS, CopyFileExW on Windows), so a userspace buffered copy would be slower
     fs::copy(history_path, &temp_path)?;
 
     let copy_time = start_time.elapsed();
@@ -232,6 +237,94 @@ pub fn copy_history_database(history_path: &Path, temp_path: Option<&Path>) -> R
     Ok(temp_path)
 }
 
+/// Opens a browser history database in place, read-only.
+///
+/// The `immutable=1` URI parameter tells SQLite the file will not change while it is open,
+/// so it takes no locks and can read the database even while the browser has it open. This
+/// avoids copying the whole file first, but the promise is not enforced: if the browser writes
+/// to the file during the read, SQLite can return stale or inconsistent rows or fail partway
+/// through a scan with `SQLITE_CORRUPT`. Because SQLite never rechecks the size of an immutable
+/// file, a memory-mapped read past a truncation would crash the process outright, so connections
+/// opened here must not enable `mmap_size` (see [`configure_connection`]). `--copy` reads a
+/// private snapshot instead.
+pub fn open_history_database(history_path: &Path) -> Result<Connection> {
+    if !history_path.exists() {
+        anyhow::bail!("History file not found at {:?}", history_path);
+    }
+
+    let mut uri = url::Url::from_file_path(history_path)
+        .map_err(|()| anyhow::anyhow!("History path {:?} is not absolute", history_path))?;
+    uri.set_query(Some("mode=ro&immutable=1"));
+
+    info!(
+        action = "open",
+        component = "database",
+        uri = uri.as_str(),
+        "Opening history database in place"
+    );
+
+    Connection::open_with_flags(
+        uri.as_str(),
+        OpenFlags::SQLITE_OPEN_READ_ONLY
+            | OpenFlags::SQLITE_OPEN_URI
+            | OpenFlags::SQLITE_OPEN_NO_MUTEX,
+    )
+    .with_context(|| {
+        format!("Failed to open history database at {history_path:?} in place; retry with --copy")
+    })
+}
+
+/// Checks whether `error` came from SQLite finding the database busy, locked, or corrupt, the
+/// failures a concurrent writer can cause while reading it in place.
+pub fn is_concurrent_write_error(error: &anyhow::Error) -> bool {
+    matches!(
+        error
+            .downcast_ref::<rusqlite::Error>()
+            .and_then(rusqlite::Error::sqlite_error_code),
+        Some(ErrorCode::DatabaseBusy | ErrorCode::DatabaseLocked | ErrorCode::DatabaseCorrupt)
+    )
+}
+
+/// Tunes a connection for one large sequential read of a history database.
+///
+/// Raises the page cache to 64 MiB and keeps any temporary tables in memory. With
+/// `memory_map`, also memory-maps up to 256 MiB of the file; only enable that for a private
+/// copy, since another process truncating a mapped file raises SIGBUS instead of an error.
+pub fn configure_connection(conn: &Connection, memory_map: bool) -> Result<()> {
+    if memory_map {
+        conn.pragma_update(None, "mmap_size", 268_435_456)?;
+    }
+    conn.pragma_update(None, "cache_size", -65_536)?;
+    conn.pragma_update(None, "temp_store", "MEMORY")?;
+
+    info!(
+        action = "configure",
+        component = "database",
+        memory_map,
+        "Configured connection pragmas"
+    );
+    Ok(())
+}
+
+/// Format used for the reported visit date range, e.g. "February 9, 2025"
+const DATE_FORMAT: &str = "%B %-d, %Y";
+
+/// Microseconds between the Chrome epoch (1601-01-01) and the Unix epoch (1970-01-01)
+const CHROME_EPOCH_OFFSET_MICROS: i64 = 11_644_473_600_000_000;
+
+fn chrome_timestamp_to_datetime(timestamp: i64) -> Result<DateTime<Utc>> {
+    unix_timestamp_to_datetime(timestamp.saturating_sub(CHROME_EPOCH_OFFSET_MICROS))
+}
+
+fn unix_timestamp_to_datetime(timestamp: i64) -> Result<DateTime<Utc>> {
+    DateTime::from_timestamp_micros(timestamp)
+        .with_context(|| format!("Visit timestamp {timestamp} is out of range"))
+}
+
+fn format_date(date: &DateTime<Utc>) -> String {
+    date.format(DATE_FORMAT).to_string()
+}
+
 pub fn get_date_range(conn: &Connection) -> Result<(String, String, i64)> {
     let start_time = Instant::now();
     info!(
@@ -250,29 +343,25 @@ pub fn get_date_range(conn: &Connection) -> Result<(String, String, i64)> {
 
     if let (Some(earliest), Some(latest)) = (earliest_timestamp, latest_timestamp) {
         // Chrome uses microseconds since 1601-01-01
-        let chrome_epoch =
-            DateTime::parse_from_rfc3339("1601-01-01T00:00:00Z")?.with_timezone(&Utc);
-        let earliest_date = chrome_epoch + chrono::Duration::microseconds(earliest);
-        let latest_date = chrome_epoch + chrono::Duration::microseconds(latest);
+        let earliest_date = chrome_timestamp_to_datetime(earliest)?;
+        let latest_date = chrome_timestamp_to_datetime(latest)?;
 
         let days_between = (latest_date - earliest_date).num_days();
+        let earliest_date = format_date(&earliest_date);
+        let latest_date = format_date(&latest_date);
         let query_time = start_time.elapsed();
 
         info!(
             action = "complete",
             component = "date_range_query",
-            earliest_date = earliest_date.format("%B %-d, %Y").to_string(),
-            latest_date = latest_date.format("%B %-d, %Y").to_string(),
+            earliest_date = earliest_date.as_str(),
+            latest_date = latest_date.as_str(),
             days_between,
             duration_ms = query_time.as_millis(),
             "Date range query completed"
         );
 
-        Ok((
-            earliest_date.format("%B %-d, %Y").to_string(),
-            latest_date.format("%B %-d, %Y").to_string(),
-            days_between,
-        ))
+        Ok((earliest_date, latest_date, days_between))
     } else {
         let query_time = start_time.elapsed();
         warn!(
@@ -307,28 +396,25 @@ pub fn get_firefox_date_range(conn: &Connection) -> Result<(String, String, i64)
 
     if let (Some(earliest), Some(latest)) = (earliest_timestamp, latest_timestamp) {
         // Firefox uses microseconds since 1970-01-01
-        let unix_epoch = DateTime::parse_from_rfc3339("1970-01-01T00:00:00Z")?.with_timezone(&Utc);
-        let earliest_date = unix_epoch + chrono::Duration::microseconds(earliest);
-        let latest_date = unix_epoch + chrono::Duration::microseconds(latest);
+        let earliest_date = unix_timestamp_to_datetime(earliest)?;
+        let latest_date = unix_timestamp_to_datetime(latest)?;
 
         let days_between = (latest_date - earliest_date).num_days();
+        let earliest_date = format_date(&earliest_date);
+        let latest_date = format_date(&latest_date);
         let query_time = start_time.elapsed();
 
         info!(
             action = "complete",
             component = "firefox_date_range_query",
-            earliest_date = earliest_date.format("%B %-d, %Y").to_string(),
-            latest_date = latest_date.format("%B %-d, %Y").to_string(),
+            earliest_date = earliest_date.as_str(),
+            latest_date = latest_date.as_str(),
             days_between,
             duration_ms = query_time.as_millis(),
             "Firefox date range query completed"
         );
 
-        Ok((
-            earliest_date.format("%B %-d, %Y").to_string(),
-            latest_date.format("%B %-d, %Y").to_string(),
-            days_between,
-        ))
+        Ok((earliest_date, latest_date, days_between))
     } else {
         let query_time = start_time.elapsed();
         warn!(
@@ -345,10 +431,21 @@ pub fn get_firefox_date_range(conn: &Connection) -> Result<(String, String, i64)
     }
 }
 
+/// Number of URL rows read from the database and processed per batch
+const URL_BATCH_SIZE: usize = 25_000;
+
+/// Number of batches per worker that may be read ahead of the pool before reading pauses
+const MAX_BATCHES_PER_WORKER: usize = 2;
+
 /// Generic domain extraction function that works for both Chrome-based and Firefox-based browsers
+///
+/// URLs are streamed from `url_query` in batches of `URL_BATCH_SIZE` rows rather than loaded
+/// all at once, and reading overlaps with processing, so memory stays bounded by the number
+/// of batches in flight regardless of history size.
 fn extract_domains_from_urls_generic(
-    urls: Vec<String>,
-    patterns: &[regex::Regex],
+    conn: &Connection,
+    url_query: &str,
+    patterns: &DomainPatterns,
     max_workers: Option<usize>,
     component_name: &str,
 ) -> Result<crate::stats::DomainStats> {
@@ -359,15 +456,6 @@ fn extract_domains_from_urls_generic(
         "Starting domain extraction from URLs"
     );
 
-    let query_time = start_time.elapsed();
-    info!(
-        action = "query",
-        component = component_name,
-        url_count = urls.len(),
-        duration_ms = query_time.as_millis(),
-        "Found URLs to process"
-    );
-
     let max_workers = max_workers.unwrap_or_else(|| {
         let cpu_count = num_cpus::get();
         std::cmp::min(cpu_count, 8)
@@ -377,65 +465,91 @@ fn extract_domains_from_urls_generic(
         action = "configure",
         component = component_name,
         worker_count = max_workers,
+        batch_size = URL_BATCH_SIZE,
         "Using workers for processing"
     );
 
     let processing_start = Instant::now();
 
-    // Use Rayon's built-in parallel iterator with automatic work-stealing
-    let batch_stats: Vec<crate::stats::DomainStats> = urls
-        .into_par_iter()
-        .fold(
-            || crate::stats::DomainStats {
-                unique_domains: Vec::new(),
-                domain_counts: std::collections::HashMap::new(),
-                domains_removed: 0,
-            },
-            |mut acc, url_str| {
-                if let Ok(url) = url::Url::parse(&url_str) {
-                    if let Some(host) = url.host_str() {
-                        if !crate::domain::has_valid_tld(host) {
-                            acc.domains_removed += 1;
-                        } else {
-                            let normalized_domain = crate::domain::normalize_domain(host, patterns);
-
-                            if !crate::domain::has_valid_tld(&normalized_domain) {
-                                acc.domains_removed += 1;
-                            } else {
-                                *acc.domain_counts.entry(normalized_domain).or_insert(0) += 1;
-                            }
-                        }
-                    }
+    // Rayon's global pool spans every core, so size a dedicated pool to honor --workers
+    let pool = rayon::ThreadPoolBuilder::new()
+        .num_threads(max_workers)
+        .build()
+        .context("Failed to build worker thread pool")?;
+
+    let mut host_counts = FxHashMap::default();
+
+    let mut stmt = conn.prepare(url_query)?;
+    let mut rows = stmt.query([])?;
+
+    // This thread keeps reading batches from SQLite while the pool counts earlier ones. At
+    // most MAX_BATCHES_PER_WORKER batches per worker are in flight, which bounds memory.
+    let max_in_flight = max_workers * MAX_BATCHES_PER_WORKER;
+    let (result_tx, result_rx) = mpsc::channel::<FxHashMap<String, u32>>();
+    // Rows are counted as they stream past rather than with a separate COUNT(*) scan
+    let mut url_count: u64 = 0;
+    pool.in_place_scope(|scope| -> Result<()> {
+        let mut in_flight = 0;
+        let mut exhausted = false;
+        while !exhausted {
+            // Only the scheme://authority prefix determines the host, and many URLs share one,
+            // so collapse each batch to its distinct prefixes before handing it to the pool
+            let mut batch = FxHashMap::default();
+            for _ in 0..URL_BATCH_SIZE {
+                let Some(row) = rows.next()? else {
+                    exhausted = true;
+                    break;
+                };
+                url_count += 1;
+                // A row that is not valid UTF-8 text is skipped instead of failing the whole
+                // query; only genuine SQLite errors propagate
+                if let Ok(url) = row.get_ref(0)?.as_str() {
+                    add_count(&mut batch, crate::domain::url_authority_prefix(url), 1);
                 }
-                acc
-            },
-        )
-        .collect();
+            }
+            if batch.is_empty() {
+                continue;
+            }
 
-    // Merge all results from fold operations
-    let mut all_stats = crate::stats::DomainStats {
-        unique_domains: Vec::new(),
-        domain_counts: std::collections::HashMap::new(),
-        domains_removed: 0,
-    };
+            if in_flight == max_in_flight {
+                host_counts = merge_counts(std::mem::take(&mut host_counts), result_rx.recv()?);
+                in_flight -= 1;
+            }
 
-    for stats in batch_stats {
-        all_stats.unique_domains.extend(stats.unique_domains);
-        for (domain, count) in stats.domain_counts {
-            *all_stats.domain_counts.entry(domain).or_insert(0) += count;
+            let result_tx = result_tx.clone();
+            scope.spawn(move |_| {
+                // The receiver outlives the scope, so sending cannot fail
+                let _ = result_tx.send(count_url_hosts(batch));
+            });
+            in_flight += 1;
         }
-        all_stats.domains_removed += stats.domains_removed;
+        Ok(())
+    })?;
+
+    // Every batch has finished once the scope returns
+    drop(result_tx);
+    for batch_counts in result_rx {
+        host_counts = merge_counts(host_counts, batch_counts);
     }
 
-    // Update unique_domains from the final domain_counts
-    all_stats.unique_domains = all_stats.domain_counts.keys().cloned().collect();
+    info!(
+        action = "count",
+        component = component_name,
+        url_count,
+        unique_hosts = host_counts.len(),
+        "Counted unique hosts"
+    );
+
+    // History repeats the same hosts heavily, so validate and normalize each one only once
+    let all_stats = classify_hosts(host_counts, patterns);
 
     let total_processing_time = processing_start.elapsed();
     let total_time = start_time.elapsed();
     info!(
         action = "complete",
         component = component_name,
-        unique_domains = all_stats.unique_domains.len(),
+        url_count,
+        unique_domains = all_stats.domain_counts.len(),
         domains_removed = all_stats.domains_removed,
         "Domain extraction completed"
     );
@@ -450,60 +564,219 @@ fn extract_domains_from_urls_generic(
     Ok(all_stats)
 }
 
+/// Counts the hosts of a batch of URL prefix counts in parallel on the current Rayon pool
+///
+/// Hosts are short, trusted keys, so the maps use FxHash instead of the DoS-resistant but
+/// much slower default SipHash.
+fn count_url_hosts(prefix_counts: FxHashMap<String, u32>) -> FxHashMap<String, u32> {
+    // Use Rayon's built-in parallel iterator with automatic work-stealing
+    prefix_counts
+        .into_par_iter()
+        .fold(FxHashMap::default, |mut acc, (prefix, count)| {
+            if let Some(host) = crate::domain::extract_host(&prefix) {
+                add_count(&mut acc, &host, count);
+            }
+            acc
+        })
+        .reduce(FxHashMap::default, merge_counts)
+}
+
+/// Adds `count` to `key`, only allocating an owned key the first time it is seen
+fn add_count(counts: &mut FxHashMap<String, u32>, key: &str, count: u32) {
+    if let Some(existing) = counts.get_mut(key) {
+        *existing += count;
+    } else {
+        counts.insert(key.to_owned(), count);
+    }
+}
+
+/// Merges the counts of `from` into `into`, reusing whichever map is larger
+fn merge_counts(
+    mut into: FxHashMap<String, u32>,
+    mut from: FxHashMap<String, u32>,
+) -> FxHashMap<String, u32> {
+    if from.len() > into.len() {
+        std::mem::swap(&mut into, &mut from);
+    }
+    for (key, count) in from {
+        *into.entry(key).or_insert(0) += count;
+    }
+    into
+}
+
+/// Validates and normalizes each unique host, attributing its visits to the resulting domain
+fn classify_hosts(
+    host_counts: FxHashMap<String, u32>,
+    patterns: &DomainPatterns,
+) -> crate::stats::DomainStats {
+    // Specialize once up front so --no-patterns runs a loop with pattern matching compiled out
+    if patterns.is_empty() {
+        classify_hosts_with(host_counts, |_| None)
+    } else {
+        classify_hosts_with(host_counts, |domain| patterns.captured(domain))
+    }
+}
+
+fn classify_hosts_with<F>(
+    host_counts: FxHashMap<String, u32>,
+    captured: F,
+) -> crate::stats::DomainStats
+where
+    F: for<'a> Fn(&'a str) -> Option<&'a str>,
+{
+    let mut stats = crate::stats::DomainStats::default();
+
+    for (host, count) in host_counts {
+        if !crate::domain::has_valid_tld(&host) {
+            stats.domains_removed += count;
+            continue;
+        }
+
+        // Trimming only drops leading labels, so the TLD needs rechecking only when a
+        // pattern rewrote the domain to its capture group
+        let trimmed_domain = crate::domain::trim_domain(&host);
+        let normalized_domain = match captured(trimmed_domain) {
+            Some(captured) if !crate::domain::has_valid_tld(captured) => {
+                stats.domains_removed += count;
+                continue;
+            }
+            Some(captured) => captured,
+            None => trimmed_domain,
+        };
+
+        *stats
+            .domain_counts
+            .entry(normalized_domain.to_string())
+            .or_insert(0) += count;
+    }
+
+    stats
+}
+
 pub fn extract_domains_from_urls(
     conn: &Connection,
-    patterns: &[regex::Regex],
+    patterns: &DomainPatterns,
     max_workers: Option<usize>,
 ) -> Result<crate::stats::DomainStats> {
-    let start_time = Instant::now();
-    info!(
-        action = "start",
-        component = "domain_extraction",
-        "Starting domain extraction from URLs"
-    );
-
-    let urls: Vec<String> = conn
-        .prepare("SELECT url FROM urls")?
-        .query_map([], |row| row.get(0))?
-        .collect::<SqliteResult<Vec<String>>>()?;
-
-    let query_time = start_time.elapsed();
-    info!(
-        action = "query",
-        component = "domain_extraction",
-        url_count = urls.len(),
-        duration_ms = query_time.as_millis(),
-        "Found URLs to process"
-    );
-
-    extract_domains_from_urls_generic(urls, patterns, max_workers, "domain_extraction")
+    extract_domains_from_urls_generic(
+        conn,
+        "SELECT url FROM urls WHERE url LIKE 'http%://%'",
+        patterns,
+        max_workers,
+        "domain_extraction",
+    )
 }
 
 pub fn extract_domains_from_firefox_urls(
     conn: &Connection,
-    patterns: &[regex::Regex],
+    patterns: &DomainPatterns,
     max_workers: Option<usize>,
 ) -> Result<crate::stats::DomainStats> {
-    let start_time = Instant::now();
-    info!(
-        action = "start",
-        component = "firefox_domain_extraction",
-        "Starting Firefox domain extraction from URLs"
-    );
+    extract_domains_from_urls_generic(
+        conn,
+        "SELECT url FROM moz_places WHERE url LIKE 'http%://%'",
+        patterns,
+        max_workers,
+        "firefox_domain_extraction",
+    )
+}
 
-    let urls: Vec<String> = conn
-        .prepare("SELECT url FROM moz_places WHERE url IS NOT NULL")?
-        .query_map([], |row| row.get(0))?
-        .collect::<SqliteResult<Vec<String>>>()?;
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use regex::Regex;
+    use std::collections::HashMap;
+
+    fn expected_counts(counts: &[(&str, u32)]) -> HashMap<String, u32> {
+        counts
+            .iter()
+            .map(|&(domain, count)| (domain.to_string(), count))
+            .collect()
+    }
 
-    let query_time = start_time.elapsed();
-    info!(
-        action = "query",
-        component = "firefox_domain_extraction",
-        url_count = urls.len(),
-        duration_ms = query_time.as_millis(),
-        "Found Firefox URLs to process"
-    );
+    fn host_counts(counts: &[(&str, u32)]) -> FxHashMap<String, u32> {
+        counts
+            .iter()
+            .map(|&(host, count)| (host.to_string(), count))
+            .collect()
+    }
 
-    extract_domains_from_urls_generic(urls, patterns, max_workers, "firefox_domain_extraction")
+    #[test]
+    fn extract_domains_streams_batches_through_pipeline() -> Result<()> {
+        let conn = Connection::open_in_memory()?;
+        conn.execute_batch(
+            "CREATE TABLE urls (id INTEGER PRIMARY KEY, url LONGVARCHAR);
+             INSERT INTO urls (url) VALUES
+                 ('HTTPS://User@Docs.Example.COM:443/a'),
+                 ('chrome://settings/'),
+                 (X'687474703A2F2F626C6F622E6578616D706C652E636F6D2F'),
+                 ('http://localhost:8080/');",
+        )?;
+
+        // The query skips the chrome:// and BLOB rows, so six other rows plus these fill exactly
+        // four batches: with one worker the in-flight cap is reached and the final read yields
+        // an empty batch
+        let bulk_rows = 4 * URL_BATCH_SIZE - 6;
+        conn.execute(
+            "INSERT INTO urls (url)
+             WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?1)
+             SELECT 'https://www.example.com/page/' || i FROM n",
+            [bulk_rows],
+        )?;
+        conn.execute_batch(
+            "INSERT INTO urls (url) VALUES
+                 ('http://docs.example.com/b'),
+                 ('http://a.b.c.example.org/x?q=1'),
+                 -- Matches the query but is not valid UTF-8, so it is skipped
+                 (CAST(X'687474703A2F2FFF2E636F6D2F' AS TEXT)),
+                 ('http://192.168.0.1/');",
+        )?;
+
+        let stats = extract_domains_from_urls(&conn, &DomainPatterns::default(), Some(1))?;
+
+        assert_eq!(
+            stats.domain_counts,
+            expected_counts(&[
+                ("www.example.com", bulk_rows as u32),
+                ("docs.example.com", 2),
+                ("c.example.org", 1),
+            ])
+        );
+        assert_eq!(stats.domains_removed, 2);
+        Ok(())
+    }
+
+    #[test]
+    fn classify_hosts_applies_patterns_after_trimming() -> Result<()> {
+        let patterns = DomainPatterns::new(vec![
+            Regex::new(r"^(.+)\.example\.com$")?,
+            Regex::new(r"^.+\.(example\.org)$")?,
+        ])?;
+        let hosts = [
+            ("www.example.com", 3),
+            ("news.example.org", 2),
+            ("a.b.c.example.net", 4),
+            ("localhost", 5),
+        ];
+
+        // "www.example.com" is rewritten to "www", which has no valid TLD
+        let stats = classify_hosts(host_counts(&hosts), &patterns);
+        assert_eq!(
+            stats.domain_counts,
+            expected_counts(&[("example.org", 2), ("c.example.net", 4)])
+        );
+        assert_eq!(stats.domains_removed, 8);
+
+        let stats = classify_hosts(host_counts(&hosts), &DomainPatterns::default());
+        assert_eq!(
+            stats.domain_counts,
+            expected_counts(&[
+                ("www.example.com", 3),
+                ("news.example.org", 2),
+                ("c.example.net", 4),
+            ])
+        );
+        assert_eq!(stats.domains_removed, 5);
+        Ok(())
+    }
 }
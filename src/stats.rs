@@ -1,8 +1,7 @@
 use std::collections::HashMap;
 
-#[derive(Debug)]
+#[derive(Debug, Default)]
 pub struct DomainStats {
-    pub unique_domains: Vec<String>,
     pub domain_counts: HashMap<String, u32>,
     pub domains_removed: u32,
 }